@@ -5,11 +5,15 @@ LESLI45BOT - ИСПРАВЛЕННАЯ ВЕРСИЯ
 Использует POSTGRES_URL вместо DATABASE_URL
 """
 
+import hashlib
 import logging
 import os
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import psycopg2
-from psycopg2.extras import RealDictCursor
 
 # Telegram Bot
 import telebot
@@ -31,6 +35,16 @@ class Config:
     TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
     POSTGRES_URL = os.getenv('POSTGRES_URL')  # ИЗМЕНЕНО!
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '512'))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '300'))  # секунды
+    # База знаний пополняется вне бота, COUNT(*) незачем считать на каждый /start
+    KNOWLEDGE_COUNT_TTL = int(os.getenv('KNOWLEDGE_COUNT_TTL', '300'))  # секунды
+    # Сколько апдейтов обрабатывается параллельно (ответ OpenAI идет секундами)
+    BOT_THREADS = int(os.getenv('BOT_THREADS', '8'))
+    # Как часто (в секундах) обновлять сообщение, пока ответ ИИ генерируется
+    STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+    # Сколько (в секундах) дубликат вопроса ждет уже идущий запрос к OpenAI
+    PENDING_REQUEST_TIMEOUT = float(os.getenv('PENDING_REQUEST_TIMEOUT', '60'))
     
     def __init__(self):
         if not self.TELEGRAM_TOKEN:
@@ -43,7 +57,22 @@ class Config:
 config = Config()
 
 # Инициализация бота
-bot = telebot.TeleBot(config.TELEGRAM_TOKEN)
+bot = telebot.TeleBot(config.TELEGRAM_TOKEN, num_threads=config.BOT_THREADS)
+
+# Системный промпт не меняется между запросами
+SYSTEM_PROMPT = """Ты LESLI45BOT - персональный ассистент по соблазнению на основе методик Алекса Лесли.
+
+Твоя задача:
+• Помогать в общении с девушками
+• Давать конкретные советы по соблазнению
+• Анализировать ситуации и переписки
+• Использовать знания из книг Лесли
+
+Стиль общения:
+• Дружелюбный и поддерживающий
+• Конкретные советы без лишних слов
+• Используй эмодзи для наглядности
+• Будь экспертом, но не занудой"""
 
 class LesliAssistant:
     """Основной класс ассистента"""
@@ -51,6 +80,13 @@ class LesliAssistant:
     def __init__(self):
         self.setup_database()
         self.openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+        # Кэш ответов ИИ: хэш нормализованного вопроса -> (ответ, когда протухает), LRU
+        self.response_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        # Запросы, которые сейчас выполняются: ключ кэша -> Future с ответом
+        self.pending_requests = {}
+        # Последний подсчет записей базы знаний: (количество, когда протухает)
+        self.knowledge_count_cache = None
         logger.info("✅ Ассистент инициализирован")
 
     def setup_database(self):
@@ -65,6 +101,7 @@ class LesliAssistant:
                 self.db.autocommit = True
                 logger.info("✅ Подключение к PostgreSQL успешно!")
                 self.create_tables()
+                self.create_indexes()
             else:
                 logger.error("❌ POSTGRES_URL не найден!")
                 sys.exit(1)
@@ -84,30 +121,62 @@ class LesliAssistant:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                # Поисковый вектор считается при записи, а не на каждый запрос
+                cursor.execute("""
+                    ALTER TABLE knowledge_base
+                    ADD COLUMN IF NOT EXISTS content_tsv tsvector
+                    GENERATED ALWAYS AS (to_tsvector('russian', coalesce(content, ''))) STORED
+                """)
                 logger.info("✅ Таблицы созданы")
         except Exception as e:
             logger.error(f"❌ Ошибка создания таблиц: {e}")
 
-    def get_knowledge_count(self):
-        """Получить количество записей в базе"""
+    def create_indexes(self):
+        """Создание индексов для поиска"""
+        try:
+            with self.db.cursor() as cursor:
+                # Полнотекстовый индекс по content_tsv для search_knowledge
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_knowledge_content_tsv
+                    ON knowledge_base USING gin (content_tsv)
+                """)
+                logger.info("✅ Индексы созданы")
+        except Exception as e:
+            logger.error(f"❌ Ошибка создания индексов: {e}")
+
+    def get_knowledge_count(self, fresh=False):
+        """Получить количество записей в базе (fresh=True - мимо кэша)"""
+        cached = self.knowledge_count_cache
+        if not fresh and cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+        
         try:
             with self.db.cursor() as cursor:
                 cursor.execute("SELECT COUNT(*) FROM knowledge_base")
                 result = cursor.fetchone()
-                return result[0] if result else 0
+                count = result[0] if result else 0
+                self.knowledge_count_cache = (count, time.monotonic() + config.KNOWLEDGE_COUNT_TTL)
+                return count
         except Exception as e:
             logger.error(f"Ошибка подсчета записей: {e}")
             return 0
 
-    def search_knowledge(self, query):
-        """Поиск в базе знаний"""
+    def search_knowledge(self, query, limit=3):
+        """Поиск в базе знаний
+        
+        Полнотекстовый поиск по любому из слов запроса (OR),
+        самые релевантные фрагменты первыми.
+        """
         try:
             with self.db.cursor() as cursor:
                 cursor.execute("""
-                    SELECT content FROM knowledge_base 
-                    WHERE content ILIKE %s 
-                    LIMIT 3
-                """, (f'%{query}%',))
+                    SELECT content
+                    FROM knowledge_base,
+                         CAST(replace(plainto_tsquery('russian', %s)::text, ' & ', ' | ') AS tsquery) AS q
+                    WHERE content_tsv @@ q
+                    ORDER BY ts_rank(content_tsv, q) DESC
+                    LIMIT %s
+                """, (query, limit))
                 
                 results = cursor.fetchall()
                 return [row[0] for row in results]
@@ -115,45 +184,122 @@ class LesliAssistant:
             logger.error(f"Ошибка поиска: {e}")
             return []
 
-    def get_ai_response(self, user_message, user_id=None):
-        """Получение ответа от OpenAI"""
-        try:
-            # Ищем в базе знаний
-            knowledge = self.search_knowledge(user_message)
-            
-            # Формируем системный промпт
-            system_prompt = """Ты LESLI45BOT - персональный ассистент по соблазнению на основе методик Алекса Лесли.
-
-Твоя задача:
-• Помогать в общении с девушками
-• Давать конкретные советы по соблазнению
-• Анализировать ситуации и переписки
-• Использовать знания из книг Лесли
+    def make_cache_key(self, user_message):
+        """Ключ кэша: одинаковые вопросы с точностью до регистра и пробелов"""
+        normalized = " ".join(user_message.lower().split())
+        return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
 
-Стиль общения:
-• Дружелюбный и поддерживающий
-• Конкретные советы без лишних слов
-• Используй эмодзи для наглядности
-• Будь экспертом, но не занудой"""
+    def get_cached_response(self, cache_key):
+        """Ответ из кэша или None (вызывать под cache_lock)"""
+        entry = self.response_cache.get(cache_key)
+        if entry is None:
+            return None
+        
+        answer, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self.response_cache[cache_key]
+            return None
+        
+        self.response_cache.move_to_end(cache_key)
+        return answer
+
+    def cache_response(self, cache_key, answer):
+        """Сохранить ответ в кэш, вытесняя самый старый"""
+        with self.cache_lock:
+            self.response_cache[cache_key] = (answer, time.monotonic() + config.RESPONSE_CACHE_TTL)
+            self.response_cache.move_to_end(cache_key)
+            if len(self.response_cache) > config.RESPONSE_CACHE_SIZE:
+                self.response_cache.popitem(last=False)
+
+    def drop_cached_response(self, user_message):
+        """Убрать ответ из кэша (например, если его не удалось доставить)"""
+        with self.cache_lock:
+            self.response_cache.pop(self.make_cache_key(user_message), None)
+
+    def request_ai_response(self, user_message, on_partial=None):
+        """Запрос ответа у OpenAI без кэша
+        
+        Ответ приходит потоком; on_partial(text) получает накопленный текст
+        не чаще раза в STREAM_EDIT_INTERVAL секунд.
+        """
+        # Ищем в базе знаний (в промпт идет только первый фрагмент)
+        knowledge = self.search_knowledge(user_message, limit=1)
+        
+        # Статичный промпт идет первым и не меняется - OpenAI кэширует такой префикс,
+        # а найденный фрагмент уходит отдельным сообщением после него
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if knowledge:
+            messages.append({"role": "system", "content": f"Из базы знаний Лесли:\n{knowledge[0][:500]}..."})
+        messages.append({"role": "user", "content": user_message})
+
+        response = self.openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=1000,
+            temperature=0.7,
+            stream=True
+        )
+        
+        parts = []
+        last_update = 0.0
+        for chunk in response:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            
+            now = time.monotonic()
+            if on_partial and now - last_update >= config.STREAM_EDIT_INTERVAL:
+                last_update = now
+                on_partial("".join(parts))
+        
+        answer = "".join(parts).strip()
+        if not answer:
+            # Пустой поток (фильтр контента, одни пробелы) - это ошибка, а не ответ для кэша
+            raise ValueError("OpenAI вернул пустой ответ")
+        return answer
 
-            if knowledge:
-                system_prompt += f"\n\nИз базы знаний Лесли:\n{knowledge[0][:500]}..."
-
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
+    def get_ai_response(self, user_message, user_id=None, on_partial=None):
+        """Получение ответа от OpenAI"""
+        # Одинаковые вопросы не гоняем в OpenAI
+        cache_key = self.make_cache_key(user_message)
+
+        # Кэш и запросы в работе проверяем под одной блокировкой - иначе ответ,
+        # сохраненный между проверками, запросится повторно.
+        # Одновременные одинаковые вопросы ждут один общий запрос
+        with self.cache_lock:
+            cached = self.get_cached_response(cache_key)
+            if cached is not None:
+                return cached
             
-            return response.choices[0].message.content.strip()
+            pending = self.pending_requests.get(cache_key)
+            is_owner = pending is None
+            if is_owner:
+                pending = self.pending_requests[cache_key] = Future()
+
+        try:
+            if not is_owner:
+                return pending.result(timeout=config.PENDING_REQUEST_TIMEOUT)
+
+            try:
+                answer = self.request_ai_response(user_message, on_partial)
+            except Exception as e:
+                pending.set_exception(e)
+                raise
+
+            self.cache_response(cache_key, answer)
+            pending.set_result(answer)
+            return answer
             
+        except FutureTimeoutError:
+            logger.error("❌ Не дождались ответа OpenAI на такой же вопрос")
+            return "❌ Извини, временные проблемы с ИИ. Попробуй позже!"
         except Exception as e:
             logger.error(f"❌ Ошибка OpenAI: {e}")
             return "❌ Извини, временные проблемы с ИИ. Попробуй позже!"
+        finally:
+            if is_owner:
+                with self.cache_lock:
+                    self.pending_requests.pop(cache_key, None)
 
 # Глобальный экземпляр
 assistant = LesliAssistant()
@@ -188,12 +334,35 @@ def create_main_menu():
     
     return markup
 
-@bot.message_handler(commands=['start'])
-def start_command(message):
-    """Обработка команды /start"""
-    user_name = message.from_user.first_name or "друг"
-    
-    welcome_text = f"""🔥 **Привет, {user_name}!**
+def create_back_button():
+    """Кнопка возврата в главное меню"""
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔙 Главное меню", callback_data="menu_back"))
+    return markup
+
+# Клавиатуры статичны - собираем их один раз при запуске
+MAIN_MENU_MARKUP = create_main_menu()
+BACK_MARKUP = create_back_button()
+PHOTO_MARKUP = types.InlineKeyboardMarkup().add(
+    types.InlineKeyboardButton("💬 Анализ переписки", callback_data="menu_perepiska")
+)
+
+# Простые ответы для каждой кнопки меню
+MENU_RESPONSES = {
+    "situacia": "🎯 **Конкретная ситуация**\n\nОпиши свою ситуацию с девушкой максимально подробно, и я дам конкретные советы как действовать дальше!",
+    "perepiska": "💬 **Анализ переписки**\n\nПришли скрин переписки или опиши диалог. Проанализирую её интерес и подскажу что писать дальше!",
+    "pervoe": "📱 **Первое сообщение**\n\nРасскажи где познакомился с девушкой и что о ней знаешь. Составлю идеальное первое сообщение!",
+    "razogrev": "🔥 **Разогрев и флирт**\n\nОпиши на какой стадии общения вы находитесь. Дам техники разогрева и эскалации!",
+    "zvonki": "📞 **Звонки и свидания**\n\nРасскажи о ситуации с девушкой. Подскажу как правильно назначать встречи и проводить свидания!",
+    "sos": "🆘 **SOS Сигналы**\n\nЭкстренная ситуация? Быстро опиши проблему - дам срочный совет из арсенала Лесли!"
+}
+
+MENU_DEFAULT_RESPONSE = "🤖 Опиши свою ситуацию, и я помогу!"
+
+MAIN_MENU_TEXT = "🔥 **LESLI45BOT - Главное меню**\n\nВыбери раздел для получения экспертных советов по соблазнению! 👇"
+
+# Шаблоны текстов: разбираются один раз, в обработчиках только format()
+WELCOME_TEMPLATE = """🔥 **Привет, {user_name}!**
 
 Я LESLI45BOT - твой персональный ассистент по соблазнению на основе методик **Алекса Лесли**.
 
@@ -205,33 +374,60 @@ def start_command(message):
 • 🧠 Давать психологические инсайты
 • 💡 Обучать фреймам и техникам
 
-📚 **База знаний:** {assistant.get_knowledge_count()} записей из книг Лесли
+📚 **База знаний:** {count} записей из книг Лесли
 🤖 **ИИ:** GPT-4o для персональных советов
 
 Используй кнопки ниже для быстрого доступа к функциям! 👇"""
-    
-    bot.send_message(
-        message.chat.id,
-        welcome_text,
-        reply_markup=create_main_menu(),
-        parse_mode='Markdown'
-    )
 
-@bot.message_handler(commands=['debug'])
-def debug_command(message):
-    """Диагностика базы знаний"""
-    count = assistant.get_knowledge_count()
-    debug_text = f"""🔍 **ДИАГНОСТИКА БАЗЫ ЗНАНИЙ**
+DEBUG_TEMPLATE = """🔍 **ДИАГНОСТИКА БАЗЫ ЗНАНИЙ**
 
 📊 **Статистика:**
 • Записей в базе: {count}
-• Статус: {'✅ Готова' if count > 0 else '❌ Пуста'}
+• Статус: {status}
 
 🔧 **Система:**
 • База данных: PostgreSQL (Render)
 • Подключение: POSTGRES_URL
 • OpenAI: GPT-4o
 • Библиотека: pyTelegramBotAPI"""
+
+PHOTO_RESPONSE = """📸 **Получил фото!**
+
+Пока не умею анализировать изображения, но могу дать отличные советы по анализу переписки!
+
+🔥 **Опиши текстом:**
+• Что она пишет
+• Как быстро отвечает  
+• Какие эмодзи использует
+• Задает ли вопросы
+
+И получишь экспертный анализ! 💪"""
+
+@bot.message_handler(commands=['start'])
+def start_command(message):
+    """Обработка команды /start"""
+    user_name = message.from_user.first_name or "друг"
+    welcome_text = WELCOME_TEMPLATE.format(
+        user_name=user_name,
+        count=assistant.get_knowledge_count()
+    )
+    
+    bot.send_message(
+        message.chat.id,
+        welcome_text,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='Markdown'
+    )
+
+@bot.message_handler(commands=['debug'])
+def debug_command(message):
+    """Диагностика базы знаний"""
+    # Диагностика должна видеть базу как есть, а не кэш
+    count = assistant.get_knowledge_count(fresh=True)
+    debug_text = DEBUG_TEMPLATE.format(
+        count=count,
+        status='✅ Готова' if count > 0 else '❌ Пуста'
+    )
     
     bot.reply_to(message, debug_text, parse_mode='Markdown')
 
@@ -239,37 +435,33 @@ def debug_command(message):
 def handle_callback(call):
     """Обработка нажатий кнопок"""
     try:
+        # Сразу подтверждаем нажатие, иначе кнопка "крутится" до таймаута.
+        # Старые запросы (например, после рестарта) Telegram отклоняет - это не повод не ответить
+        try:
+            bot.answer_callback_query(call.id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось подтвердить нажатие: {e}")
+        
         if call.data == "menu_back":
             bot.edit_message_text(
-                "🔥 **LESLI45BOT - Главное меню**\n\nВыбери раздел для получения экспертных советов по соблазнению! 👇",
+                MAIN_MENU_TEXT,
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                reply_markup=create_main_menu(),
+                reply_markup=MAIN_MENU_MARKUP,
                 parse_mode='Markdown'
             )
             return
 
-        menu_type = call.data.replace("menu_", "")
+        # callback_data имеет вид "menu_<раздел>"; replace() испортил бы "menu_menu_x"
+        _, _, menu_type = call.data.partition("_")
         
-        # Простые ответы для каждой кнопки
-        responses = {
-            "situacia": "🎯 **Конкретная ситуация**\n\nОпиши свою ситуацию с девушкой максимально подробно, и я дам конкретные советы как действовать дальше!",
-            "perepiska": "💬 **Анализ переписки**\n\nПришли скрин переписки или опиши диалог. Проанализирую её интерес и подскажу что писать дальше!",
-            "pervoe": "📱 **Первое сообщение**\n\nРасскажи где познакомился с девушкой и что о ней знаешь. Составлю идеальное первое сообщение!",
-            "razogrev": "🔥 **Разогрев и флирт**\n\nОпиши на какой стадии общения вы находитесь. Дам техники разогрева и эскалации!",
-            "zvonki": "📞 **Звонки и свидания**\n\nРасскажи о ситуации с девушкой. Подскажу как правильно назначать встречи и проводить свидания!",
-            "sos": "🆘 **SOS Сигналы**\n\nЭкстренная ситуация? Быстро опиши проблему - дам срочный совет из арсенала Лесли!"
-        }
-        
-        response_text = responses.get(menu_type, "🤖 Опиши свою ситуацию, и я помогу!")
+        response_text = MENU_RESPONSES.get(menu_type, MENU_DEFAULT_RESPONSE)
         
         bot.edit_message_text(
             text=response_text,
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton("🔙 Главное меню", callback_data="menu_back")
-            ),
+            reply_markup=BACK_MARKUP,
             parse_mode='Markdown'
         )
         
@@ -283,14 +475,52 @@ def handle_text(message):
         user_message = message.text
         user_id = message.from_user.id
         
+        draft = None
+        
+        def show_partial(text):
+            """Показываем ответ по мере генерации (без Markdown - он еще не закрыт)"""
+            nonlocal draft
+            try:
+                if draft is None:
+                    draft = bot.reply_to(message, text)
+                else:
+                    bot.edit_message_text(text, chat_id=message.chat.id, message_id=draft.message_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить черновик ответа: {e}")
+        
+        # Пока ИИ думает, пользователь видит "печатает..."
+        try:
+            bot.send_chat_action(message.chat.id, 'typing')
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось отправить статус 'печатает': {e}")
+        
         # Получаем ответ от ИИ
-        ai_response = assistant.get_ai_response(user_message, user_id)
+        ai_response = assistant.get_ai_response(user_message, user_id, on_partial=show_partial)
         
-        # Добавляем кнопку возврата в меню
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🔙 Главное меню", callback_data="menu_back"))
+        def send_answer(parse_mode):
+            """Финальный ответ с кнопкой меню: новым сообщением или правкой черновика"""
+            if draft is None:
+                bot.reply_to(message, ai_response, reply_markup=BACK_MARKUP, parse_mode=parse_mode)
+            else:
+                bot.edit_message_text(
+                    ai_response,
+                    chat_id=message.chat.id,
+                    message_id=draft.message_id,
+                    reply_markup=BACK_MARKUP,
+                    parse_mode=parse_mode
+                )
         
-        bot.reply_to(message, ai_response, reply_markup=markup, parse_mode='Markdown')
+        try:
+            send_answer('Markdown')
+        except Exception as e:
+            # GPT нередко пишет невалидный для Telegram Markdown ("* " списки, одиночные "_")
+            logger.warning(f"⚠️ Markdown не принят, отправляю ответ простым текстом: {e}")
+            try:
+                send_answer(None)
+            except Exception:
+                # Недоставленный ответ не должен остаться в кэше для следующих пользователей
+                assistant.drop_cached_response(user_message)
+                raise
         
     except Exception as e:
         logger.error(f"❌ Ошибка обработки сообщения: {e}")
@@ -299,22 +529,7 @@ def handle_text(message):
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
     """Обработка фотографий"""
-    response = """📸 **Получил фото!**
-
-Пока не умею анализировать изображения, но могу дать отличные советы по анализу переписки!
-
-🔥 **Опиши текстом:**
-• Что она пишет
-• Как быстро отвечает  
-• Какие эмодзи использует
-• Задает ли вопросы
-
-И получишь экспертный анализ! 💪"""
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("💬 Анализ переписки", callback_data="menu_perepiska"))
-    
-    bot.reply_to(message, response, reply_markup=markup, parse_mode='Markdown')
+    bot.reply_to(message, PHOTO_RESPONSE, reply_markup=PHOTO_MARKUP, parse_mode='Markdown')
 
 if __name__ == "__main__":
     try:
@@ -323,8 +538,13 @@ if __name__ == "__main__":
         logger.info("✅ Все компоненты инициализированы")
         logger.info("🤖 Бот готов к работе!")
         
-        # Запуск бота
-        bot.polling(none_stop=True, interval=1, timeout=30)
+        # Запуск бота: подписываемся только на то, что обрабатываем
+        bot.polling(
+            none_stop=True,
+            interval=0,
+            timeout=30,
+            allowed_updates=['message', 'callback_query']
+        )
         
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}")